@@ -9,19 +9,37 @@ This BFF handles:
 - API proxying to protected resources
 """
 
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
 import os
 import secrets
 import time
 import urllib.parse
-from typing import Any, Dict, Optional
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, Optional
 
 import httpx
+import jwt
+import orjson
 from fastapi import FastAPI, HTTPException, Request, Response, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, RedirectResponse, StreamingResponse
 from dotenv import load_dotenv
 from itsdangerous import URLSafeTimedSerializer, BadSignature
-from jose import jwt, JWTError
+from redis import asyncio as aioredis
+from redis.exceptions import LockError
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 # Load environment variables
 load_dotenv()
@@ -32,17 +50,82 @@ OIDC_CLIENT_ID = os.getenv("OIDC_CLIENT_ID")
 OIDC_CLIENT_SECRET = os.getenv("OIDC_CLIENT_SECRET")
 FRONTEND_ORIGIN = os.getenv("FRONTEND_ORIGIN", "http://localhost:5173")
 REDIRECT_PATH = os.getenv("REDIRECT_PATH", "/bff/callback")
+REDIRECT_URI = os.getenv("REDIRECT_URI")  # Derived from the request host and REDIRECT_PATH when unset
 SESSION_SECRET_KEY = os.getenv("SESSION_SECRET_KEY", "change-this-in-production")
 API_BASE_URL = os.getenv("API_BASE_URL")
 OIDC_SCOPES = os.getenv("OIDC_SCOPES", "openid profile email")
 COOKIE_SECURE = os.getenv("COOKIE_SECURE", "false").lower() == "true"
 COOKIE_SAMESITE = os.getenv("COOKIE_SAMESITE", "lax")
+REDIS_URL = os.getenv("REDIS_URL")
+ID_TOKEN_LEEWAY = int(os.getenv("ID_TOKEN_LEEWAY", "60"))  # Allowed clock skew with the IdP, in seconds
+
+SESSION_TTL = 24*3600  # 24 hours
+TEMP_SESSION_TTL = 600  # 10 minutes
+OIDC_CONFIG_TTL = 3600  # 1 hour
+JWKS_TTL = 300  # 5 minutes (picks up signing key rotation)
+JWKS_MIN_REFRESH_INTERVAL = 30  # Limits forced refetches for unknown key IDs
+CACHE_RETRY_BACKOFF = 30  # Seconds to keep serving a stale discovery/JWKS document after a failed refetch
+VERIFIED_COOKIE_CACHE_SIZE = 8192
+SESSION_GC_INTERVAL = 60  # seconds
+REFRESH_LOCK_TIMEOUT = 60  # seconds, longer than the token endpoint request timeout
+
+# Hop-by-hop headers (RFC 7230, section 6.1) apply to a single connection and are not proxied
+HOP_BY_HOP_HEADERS = frozenset({
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+})
 
 # Validate required configuration
 if not all([OIDC_ISSUER, OIDC_CLIENT_ID]):
     raise ValueError("OIDC_ISSUER and OIDC_CLIENT_ID are required")
 
-app = FastAPI(title="Ferentin OIDC BFF", version="1.0.0")
+# Shared HTTP client (created on startup, closed on shutdown)
+http_client: Optional[httpx.AsyncClient] = None
+
+# Session storage: Redis when REDIS_URL is set, otherwise in-memory (single process only)
+redis_client: Optional[aioredis.Redis] = None
+sessions: Dict[str, Dict[str, Any]] = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Create shared resources on startup and release them on shutdown."""
+    global http_client, redis_client, oidc_config_lock, jwks_lock
+    # Locks are created here because on Python < 3.10 they bind to the loop current at creation
+    oidc_config_lock = asyncio.Lock()
+    jwks_lock = asyncio.Lock()
+    # One pooled client keeps connections to the IdP and API alive between requests
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=30),
+        timeout=30.0,
+    )
+    if REDIS_URL:
+        redis_client = aioredis.from_url(REDIS_URL)
+    # Redis expires session keys itself; the in-memory store needs a cleanup task
+    session_gc_task = asyncio.create_task(expire_sessions_loop()) if redis_client is None else None
+    try:
+        yield
+    finally:
+        if session_gc_task is not None:
+            session_gc_task.cancel()
+        await http_client.aclose()
+        http_client = None
+        if redis_client is not None:
+            await redis_client.aclose()
+            redis_client = None
+
+app = FastAPI(
+    title="Ferentin OIDC BFF",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # CORS middleware
 app.add_middleware(
@@ -53,111 +136,450 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Session storage (in-memory for demo - use Redis/database in production)
-sessions: Dict[str, Dict[str, Any]] = {}
+class PassthroughGZipResponder(GZipResponder):
+    """GZip responder that sends already content-encoded responses (e.g. proxied) unchanged."""
+    def __init__(self, app: ASGIApp, minimum_size: int, compresslevel: int = 9) -> None:
+        super().__init__(app, minimum_size, compresslevel=compresslevel)
+        self.passthrough = False
+    
+    async def send_with_gzip(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self.passthrough = any(key.lower() == b"content-encoding" for key, _ in message.get("headers", []))
+        if self.passthrough:
+            await self.send(message)
+        else:
+            await super().send_with_gzip(message)
+
+class PassthroughGZipMiddleware(GZipMiddleware):
+    """GZip middleware that never double-compresses responses."""
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = PassthroughGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+# Response compression
+app.add_middleware(PassthroughGZipMiddleware, minimum_size=1024, compresslevel=5)
 
-# OIDC Discovery cache
+@dataclass(frozen=True)
+class OIDCEndpoints:
+    """OIDC provider endpoints, parsed once per discovery fetch."""
+    authorization_endpoint: Optional[str]
+    token_endpoint: Optional[httpx.URL]
+    jwks_uri: Optional[httpx.URL]
+    userinfo_endpoint: Optional[httpx.URL]
+    
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "OIDCEndpoints":
+        """Build endpoints from an OIDC discovery document."""
+        def parse_url(name: str) -> Optional[httpx.URL]:
+            value = config.get(name)
+            return httpx.URL(value) if value else None
+        
+        return cls(
+            authorization_endpoint=config.get("authorization_endpoint"),
+            token_endpoint=parse_url("token_endpoint"),
+            jwks_uri=parse_url("jwks_uri"),
+            userinfo_endpoint=parse_url("userinfo_endpoint"),
+        )
+
+# OIDC Discovery cache (value, monotonic fetch time); locks coalesce concurrent refetches
 oidc_config: Optional[Dict[str, Any]] = None
-jwks_cache: Optional[Dict[str, Any]] = None
+oidc_endpoints: Optional[OIDCEndpoints] = None
+oidc_config_fetched_at = 0.0
+oidc_config_lock: Optional[asyncio.Lock] = None  # Created in lifespan, on the server's event loop
+jwks_cache: Optional[jwt.PyJWKSet] = None
+jwks_fetched_at = 0.0
+jwks_attempted_at = 0.0
+jwks_lock: Optional[asyncio.Lock] = None
+
+# Per-session token refresh locks for the in-memory store (entries disappear once no request holds the lock)
+refresh_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Verified session cookies: cookie -> (session_id, cookie expiry), least recently used first
+verified_cookies: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
 
 # Utilities
+logger = logging.getLogger(__name__)
 serializer = URLSafeTimedSerializer(SESSION_SECRET_KEY)
 
 class OIDCError(Exception):
     """Custom exception for OIDC-related errors."""
     pass
 
+async def fetch_oidc_config() -> Dict[str, Any]:
+    """Fetch the OIDC discovery document."""
+    discovery_url = f"{OIDC_ISSUER.rstrip('/')}/.well-known/openid-configuration"
+    response = await http_client.get(discovery_url)
+    if response.status_code != 200:
+        raise OIDCError(f"Failed to fetch OIDC config: {response.status_code}")
+    return orjson.loads(response.content)
+
 async def get_oidc_config() -> Dict[str, Any]:
     """Fetch and cache OIDC discovery configuration."""
-    global oidc_config
-    if oidc_config is None:
-        discovery_url = f"{OIDC_ISSUER.rstrip('/')}/.well-known/openid-configuration"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(discovery_url)
-            if response.status_code != 200:
-                raise OIDCError(f"Failed to fetch OIDC config: {response.status_code}")
-            oidc_config = response.json()
+    global oidc_config, oidc_endpoints, oidc_config_fetched_at
+    if oidc_config is not None and time.monotonic() - oidc_config_fetched_at < OIDC_CONFIG_TTL:
+        return oidc_config
+    
+    async with oidc_config_lock:
+        # Another request may have refreshed the cache while we waited for the lock
+        if oidc_config is not None and time.monotonic() - oidc_config_fetched_at < OIDC_CONFIG_TTL:
+            return oidc_config
+        
+        try:
+            config = await fetch_oidc_config()
+        except (OIDCError, httpx.HTTPError, ValueError) as e:
+            if oidc_config is None:
+                raise
+            # Keep serving the cached config through an IdP outage and retry after a short backoff
+            logger.warning("OIDC discovery refetch failed, using cached config: %s", e)
+            oidc_config_fetched_at = time.monotonic() - OIDC_CONFIG_TTL + CACHE_RETRY_BACKOFF
+            return oidc_config
+        
+        oidc_config = config
+        oidc_endpoints = OIDCEndpoints.from_config(oidc_config)
+        oidc_config_fetched_at = time.monotonic()
     return oidc_config
 
-async def get_jwks() -> Dict[str, Any]:
-    """Fetch and cache JWKS for token validation."""
-    global jwks_cache
-    if jwks_cache is None:
-        config = await get_oidc_config()
-        jwks_uri = config.get("jwks_uri")
-        if not jwks_uri:
-            raise OIDCError("No jwks_uri in OIDC config")
+async def get_oidc_endpoints() -> OIDCEndpoints:
+    """Get the parsed endpoints of the cached OIDC discovery configuration."""
+    await get_oidc_config()
+    return oidc_endpoints
+
+async def fetch_jwks() -> jwt.PyJWKSet:
+    """Fetch and parse the provider JWKS."""
+    endpoints = await get_oidc_endpoints()
+    jwks_uri = endpoints.jwks_uri
+    if not jwks_uri:
+        raise OIDCError("No jwks_uri in OIDC config")
+    
+    response = await http_client.get(jwks_uri)
+    if response.status_code != 200:
+        raise OIDCError(f"Failed to fetch JWKS: {response.status_code}")
+    # Parse the keys once per fetch rather than on every token verification
+    try:
+        return jwt.PyJWKSet.from_dict(orjson.loads(response.content))
+    except jwt.PyJWTError as e:
+        raise OIDCError(f"Invalid JWKS: {str(e)}")
+
+async def get_jwks(force_refresh: bool = False) -> jwt.PyJWKSet:
+    """Fetch and cache JWKS for token validation (force_refresh refetches a cached set)."""
+    global jwks_cache, jwks_fetched_at, jwks_attempted_at
+    seen_attempted_at = jwks_attempted_at
+    if jwks_cache is not None:
+        if force_refresh:
+            if time.monotonic() - jwks_attempted_at < JWKS_MIN_REFRESH_INTERVAL:
+                return jwks_cache
+        elif time.monotonic() - jwks_fetched_at < JWKS_TTL:
+            return jwks_cache
+    
+    async with jwks_lock:
+        # Another request may have refetched (or tried to) while we waited for the lock
+        if jwks_cache is not None and jwks_attempted_at != seen_attempted_at:
+            return jwks_cache
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(jwks_uri)
-            if response.status_code != 200:
-                raise OIDCError(f"Failed to fetch JWKS: {response.status_code}")
-            jwks_cache = response.json()
+        jwks_attempted_at = time.monotonic()
+        try:
+            jwks = await fetch_jwks()
+        except (OIDCError, httpx.HTTPError, ValueError) as e:
+            if jwks_cache is None:
+                raise
+            # Keep serving the cached keys through an IdP outage and retry after a short backoff
+            logger.warning("JWKS refetch failed, using cached keys: %s", e)
+            jwks_fetched_at = time.monotonic() - JWKS_TTL + CACHE_RETRY_BACKOFF
+            return jwks_cache
+        
+        jwks_cache = jwks
+        jwks_fetched_at = time.monotonic()
     return jwks_cache
 
-def generate_pkce_challenge() -> tuple[str, str]:
-    """Generate PKCE code verifier and challenge."""
-    code_verifier = secrets.token_urlsafe(32)
-    # For simplicity, using plain method (should use S256 in production)
-    code_challenge = code_verifier
-    return code_verifier, code_challenge
-
-def create_session(user_info: Dict[str, Any], tokens: Dict[str, Any]) -> str:
-    """Create a new session and return session ID."""
-    session_id = secrets.token_urlsafe(32)
-    sessions[session_id] = {
+async def verify_id_token(id_token: str) -> Dict[str, Any]:
+    """Verify ID token signature, audience, issuer and expiry and return its claims."""
+    try:
+        key_id = jwt.get_unverified_header(id_token).get("kid")
+    except jwt.PyJWTError:
+        raise OIDCError("Invalid ID token")
+    
+    jwks = await get_jwks()
+    signing_key = next((key for key in jwks.keys if key.key_id == key_id), None)
+    if signing_key is None:
+        # The provider may have rotated its keys since the JWKS was cached
+        jwks = await get_jwks(force_refresh=True)
+        signing_key = next((key for key in jwks.keys if key.key_id == key_id), None)
+    if signing_key is None:
+        raise OIDCError("Unknown ID token signing key")
+    
+    config = await get_oidc_config()
+    try:
+        return jwt.decode(
+            id_token,
+            key=signing_key.key,
+            algorithms=[signing_key.algorithm_name],
+            audience=OIDC_CLIENT_ID,
+            issuer=config.get("issuer", OIDC_ISSUER),
+            leeway=ID_TOKEN_LEEWAY,
+        )
+    except jwt.PyJWTError as e:
+        raise OIDCError(f"Invalid ID token: {str(e)}")
+
+def get_redirect_uri(request: Request) -> str:
+    """Get the OIDC callback URL for the current request."""
+    if REDIRECT_URI:
+        return REDIRECT_URI
+    return f"{request.url.scheme}://{request.url.netloc}{REDIRECT_PATH}"
+
+@lru_cache(maxsize=32)
+def build_authorization_url_prefix(authorization_endpoint: str, redirect_uri: str) -> str:
+    """Build the authorization URL up to the per-request state and code_challenge parameters."""
+    params = {
+        "response_type": "code",
+        "client_id": OIDC_CLIENT_ID,
+        "redirect_uri": redirect_uri,
+        "scope": OIDC_SCOPES,
+        "code_challenge_method": "S256",
+    }
+    separator = "&" if "?" in authorization_endpoint else "?"
+    return f"{authorization_endpoint}{separator}{urllib.parse.urlencode(params)}"
+
+def generate_random_tokens(*sizes: int) -> list[str]:
+    """Generate URL-safe random tokens of the given byte sizes from a single random read."""
+    random_bytes = secrets.token_bytes(sum(sizes))
+    tokens = []
+    offset = 0
+    for size in sizes:
+        tokens.append(base64.urlsafe_b64encode(random_bytes[offset:offset + size]).rstrip(b"=").decode("ascii"))
+        offset += size
+    return tokens
+
+def generate_pkce_challenge(code_verifier: str) -> str:
+    """Generate PKCE code challenge for a code verifier."""
+    # S256: BASE64URL(SHA256(code_verifier)) without padding (RFC 7636)
+    digest = hashlib.sha256(code_verifier.encode("ascii")).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+# Session store
+
+# Fields of a complete session hash in Redis
+SESSION_FIELDS = (b"user", b"tokens", b"csrf_token", b"created_at")
+
+# HSET only if the session still exists, so a write racing a logout can't recreate it without a TTL
+HSET_IF_EXISTS_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+end
+return 0
+"""
+
+async def save_session(session: Dict[str, Any]) -> None:
+    """Persist a full session under its session ID."""
+    session_id = session["session_id"]
+    if redis_client is None:
+        sessions[session_id] = session
+        return
+    
+    # Stored as a hash so single fields (csrf_token, tokens) can be read/written on their own
+    key = f"sess:{session_id}"
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping={
+            "user": orjson.dumps(session["user"]),
+            "tokens": orjson.dumps(session["tokens"]),
+            "csrf_token": session["csrf_token"],
+            "created_at": session["created_at"],
+        })
+        pipe.expire(key, SESSION_TTL)
+        await pipe.execute()
+
+async def load_session(session_id: str) -> Optional[Dict[str, Any]]:
+    """Load a session by ID."""
+    if redis_client is None:
+        return sessions.get(session_id)
+    
+    data = await redis_client.hgetall(f"sess:{session_id}")
+    if not all(field in data for field in SESSION_FIELDS):
+        return None
+    return {
+        "session_id": session_id,
+        "user": orjson.loads(data[b"user"]),
+        "tokens": orjson.loads(data[b"tokens"]),
+        "csrf_token": data[b"csrf_token"].decode(),
+        "created_at": float(data[b"created_at"]),
+    }
+
+async def load_session_csrf_token(session_id: str) -> Optional[str]:
+    """Load only the CSRF token of a session."""
+    if redis_client is None:
+        session = sessions.get(session_id)
+        return session.get("csrf_token") if session else None
+    
+    csrf_token = await redis_client.hget(f"sess:{session_id}", "csrf_token")
+    return csrf_token.decode() if csrf_token else None
+
+async def save_session_tokens(session: Dict[str, Any]) -> None:
+    """Persist updated tokens of an existing session (keeps the session expiry)."""
+    session_id = session["session_id"]
+    if redis_client is None:
+        if session_id in sessions:
+            sessions[session_id]["tokens"] = session["tokens"]
+        return
+    await redis_client.eval(
+        HSET_IF_EXISTS_SCRIPT, 1, f"sess:{session_id}", "tokens", orjson.dumps(session["tokens"])
+    )
+
+async def delete_session(session_id: str) -> None:
+    """Delete a session by ID."""
+    if redis_client is None:
+        sessions.pop(session_id, None)
+        return
+    await redis_client.delete(f"sess:{session_id}")
+
+async def save_temp_session(temp_session_id: str, data: Dict[str, Any]) -> None:
+    """Persist a short-lived login (PKCE) session."""
+    if redis_client is None:
+        sessions[f"temp_{temp_session_id}"] = data
+        return
+    await redis_client.set(f"temp:{temp_session_id}", orjson.dumps(data), ex=TEMP_SESSION_TTL)
+
+async def pop_temp_session(temp_session_id: str) -> Optional[Dict[str, Any]]:
+    """Fetch and remove a login (PKCE) session, so it can only be used once."""
+    if redis_client is None:
+        return sessions.pop(f"temp_{temp_session_id}", None)
+    
+    data = await redis_client.getdel(f"temp:{temp_session_id}")
+    return orjson.loads(data) if data else None
+
+async def expire_sessions_loop() -> None:
+    """Periodically remove expired sessions from the in-memory store."""
+    while True:
+        await asyncio.sleep(SESSION_GC_INTERVAL)
+        now = time.time()
+        for key, session in list(sessions.items()):
+            # Abandoned logins (callback never reached) and sessions past the cookie lifetime
+            ttl = TEMP_SESSION_TTL if key.startswith("temp_") else SESSION_TTL
+            if now - session.get("created_at", now) > ttl:
+                sessions.pop(key, None)
+
+async def create_session(user_info: Dict[str, Any], tokens: Dict[str, Any]) -> Dict[str, Any]:
+    """Create and store a new session."""
+    session_id, csrf_token = generate_random_tokens(32, 32)
+    session = {
+        "session_id": session_id,
         "user": user_info,
         "tokens": tokens,
         "created_at": time.time(),
-        "csrf_token": secrets.token_urlsafe(32)
+        "csrf_token": csrf_token
     }
-    return session_id
+    await save_session(session)
+    return session
 
-def get_session_from_request(request: Request) -> Optional[Dict[str, Any]]:
-    """Extract session from request cookies."""
+def get_session_id_from_request(request: Request) -> Optional[str]:
+    """Extract session ID from the signed session cookie."""
     session_cookie = request.cookies.get("sid")
     if not session_cookie:
         return None
     
+    # Skip signature verification for cookies we have already verified
+    cached = verified_cookies.get(session_cookie)
+    if cached is not None:
+        session_id, expires_at = cached
+        if time.time() < expires_at:
+            verified_cookies.move_to_end(session_cookie)
+            return session_id
+        del verified_cookies[session_cookie]
+        return None
+    
     try:
-        session_id = serializer.loads(session_cookie, max_age=24*3600)  # 24 hours
-        return sessions.get(session_id)
+        session_id, signed_at = serializer.loads(session_cookie, max_age=SESSION_TTL, return_timestamp=True)
     except BadSignature:
         return None
+    
+    verified_cookies[session_cookie] = (session_id, signed_at.timestamp() + SESSION_TTL)
+    if len(verified_cookies) > VERIFIED_COOKIE_CACHE_SIZE:
+        verified_cookies.popitem(last=False)
+    return session_id
+
+async def get_session_from_request(request: Request) -> Optional[Dict[str, Any]]:
+    """Extract session from request cookies."""
+    session_id = get_session_id_from_request(request)
+    if not session_id:
+        return None
+    return await load_session(session_id)
 
-def require_session(request: Request) -> Dict[str, Any]:
+async def require_session(request: Request) -> Dict[str, Any]:
     """Dependency to require valid session."""
-    session = get_session_from_request(request)
+    session = await get_session_from_request(request)
     if not session:
         raise HTTPException(status_code=401, detail="Authentication required")
     return session
 
-def require_csrf(request: Request, session: Dict[str, Any] = Depends(require_session)) -> None:
-    """Dependency to require valid CSRF token for write operations."""
+def validate_csrf(request: Request, expected_csrf: Optional[str]) -> None:
+    """Compare the X-CSRF-Token header against the session CSRF token."""
     csrf_header = request.headers.get("X-CSRF-Token")
-    expected_csrf = session.get("csrf_token")
     
-    if not csrf_header or not expected_csrf or csrf_header != expected_csrf:
+    # Constant-time comparison so response timing doesn't leak the expected token
+    if not (csrf_header and expected_csrf and hmac.compare_digest(csrf_header.encode(), expected_csrf.encode())):
         raise HTTPException(status_code=403, detail="Invalid CSRF token")
 
+async def require_csrf(request: Request) -> None:
+    """Dependency to require valid session and CSRF token for write operations."""
+    session_id = get_session_id_from_request(request)
+    expected_csrf = await load_session_csrf_token(session_id) if session_id else None
+    if expected_csrf is None:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    validate_csrf(request, expected_csrf)
+
 def require_csrf_for_writes(request: Request, session: Dict[str, Any] = Depends(require_session)) -> None:
     """Dependency to require valid CSRF token only for write operations."""
     if request.method in ["POST", "PUT", "DELETE", "PATCH"]:
-        require_csrf(request, session)
+        validate_csrf(request, session.get("csrf_token"))
+
+def tokens_need_refresh(tokens: Dict[str, Any]) -> bool:
+    """Check whether the access token is close to expiry and can be refreshed."""
+    # Refresh if token expires in less than 5 minutes (expires_at is wall-clock, it is stored with the session)
+    return bool(tokens.get("refresh_token")) and time.time() >= tokens.get("expires_at", 0) - 300
 
 async def refresh_tokens_if_needed(session: Dict[str, Any]) -> None:
     """Refresh access token if it's close to expiry."""
-    tokens = session.get("tokens", {})
-    refresh_token = tokens.get("refresh_token")
-    expires_at = tokens.get("expires_at", 0)
+    if not tokens_need_refresh(session.get("tokens", {})):
+        return
     
-    # Refresh if token expires in less than 5 minutes
-    if not refresh_token or time.time() < (expires_at - 300):
+    # Only one request per session refreshes; concurrent requests wait and reuse its tokens
+    session_id = session["session_id"]
+    if redis_client is not None:
+        # Shared sessions may be used by several workers at once, so the lock lives in Redis too
+        try:
+            async with redis_client.lock(
+                f"refresh:{session_id}",
+                timeout=REFRESH_LOCK_TIMEOUT,
+                blocking_timeout=REFRESH_LOCK_TIMEOUT,
+            ):
+                await _refresh_tokens(session)
+        except LockError:
+            # Lock not acquired in time (or it expired mid-refresh); keep the current tokens
+            pass
         return
     
+    lock = refresh_locks.get(session_id)
+    if lock is None:
+        lock = refresh_locks[session_id] = asyncio.Lock()
+    
+    async with lock:
+        await _refresh_tokens(session)
+
+async def _refresh_tokens(session: Dict[str, Any]) -> None:
+    """Refresh the session tokens (caller holds the session refresh lock)."""
+    # Pick up tokens stored by a refresh that completed while we were waiting
+    stored_session = await load_session(session["session_id"])
+    if not stored_session:
+        return
+    session["tokens"] = stored_session["tokens"]
+    if not tokens_need_refresh(session["tokens"]):
+        return
+    
+    refresh_token = session["tokens"]["refresh_token"]
     try:
-        config = await get_oidc_config()
-        token_endpoint = config.get("token_endpoint")
+        endpoints = await get_oidc_endpoints()
+        token_endpoint = endpoints.token_endpoint
         
         token_data = {
             "grant_type": "refresh_token",
@@ -168,14 +590,14 @@ async def refresh_tokens_if_needed(session: Dict[str, Any]) -> None:
         if OIDC_CLIENT_SECRET:
             token_data["client_secret"] = OIDC_CLIENT_SECRET
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(token_endpoint, data=token_data)
-            if response.status_code == 200:
-                new_tokens = response.json()
-                # Update session with new tokens
-                session["tokens"].update(new_tokens)
-                if "expires_in" in new_tokens:
-                    session["tokens"]["expires_at"] = time.time() + new_tokens["expires_in"]
+        response = await http_client.post(token_endpoint, data=token_data)
+        if response.status_code == 200:
+            new_tokens = orjson.loads(response.content)
+            # Update session with new tokens
+            session["tokens"].update(new_tokens)
+            if "expires_in" in new_tokens:
+                session["tokens"]["expires_at"] = time.time() + new_tokens["expires_in"]
+            await save_session_tokens(session)
     except Exception:
         # If refresh fails, let the session expire naturally
         pass
@@ -191,42 +613,36 @@ async def root():
 async def login(request: Request):
     """Initiate OIDC login flow."""
     try:
-        config = await get_oidc_config()
-        authorization_endpoint = config.get("authorization_endpoint")
+        endpoints = await get_oidc_endpoints()
+        authorization_endpoint = endpoints.authorization_endpoint
         
         if not authorization_endpoint:
             raise OIDCError("No authorization_endpoint in OIDC config")
         
         # Generate PKCE parameters
-        code_verifier, code_challenge = generate_pkce_challenge()
-        temp_session_id = secrets.token_urlsafe(16)
+        code_verifier, temp_session_id, state_random = generate_random_tokens(32, 16, 16)
+        code_challenge = generate_pkce_challenge(code_verifier)
         
         # Encode temp_session_id in the state parameter
         state_data = {
             "temp_session": temp_session_id,
-            "random": secrets.token_urlsafe(16)
+            "random": state_random
         }
         state = serializer.dumps(state_data)
         
         # Store PKCE parameters in temporary session
-        sessions[f"temp_{temp_session_id}"] = {
+        await save_temp_session(temp_session_id, {
             "code_verifier": code_verifier,
             "state": state,
             "created_at": time.time()
-        }
-        
-        # Build authorization URL
-        params = {
-            "response_type": "code",
-            "client_id": OIDC_CLIENT_ID,
-            "redirect_uri": f"{request.url.scheme}://{request.url.netloc}{REDIRECT_PATH}",
-            "scope": OIDC_SCOPES,
-            "state": state,
-            "code_challenge": code_challenge,
-            "code_challenge_method": "plain",  # Use S256 in production
-        }
+        })
         
-        auth_url = f"{authorization_endpoint}?{urllib.parse.urlencode(params)}"
+        # Build authorization URL (only state and code_challenge change per request)
+        auth_url = (
+            build_authorization_url_prefix(authorization_endpoint, get_redirect_uri(request))
+            + "&state=" + urllib.parse.quote(state, safe="")
+            + "&code_challenge=" + urllib.parse.quote(code_challenge, safe="")
+        )
         return RedirectResponse(url=auth_url)
         
     except Exception as e:
@@ -246,8 +662,8 @@ async def callback(request: Request, code: str, state: str):
         if not temp_session_id:
             raise OIDCError("Missing temp_session in state")
         
-        # Retrieve temporary session
-        temp_session_data = sessions.get(f"temp_{temp_session_id}")
+        # Retrieve and clean up temporary session
+        temp_session_data = await pop_temp_session(temp_session_id)
         if not temp_session_data:
             raise OIDCError("Invalid or expired temporary session")
         
@@ -255,17 +671,16 @@ async def callback(request: Request, code: str, state: str):
         if state != temp_session_data.get("state"):
             raise OIDCError("Invalid state parameter")
         
-        # Clean up temporary session
-        sessions.pop(f"temp_{temp_session_id}", None)
-        
-        config = await get_oidc_config()
-        token_endpoint = config.get("token_endpoint")
+        endpoints = await get_oidc_endpoints()
+        token_endpoint = endpoints.token_endpoint
+        if not token_endpoint:
+            raise OIDCError("No token_endpoint in OIDC config")
         
         # Exchange code for tokens
         token_data = {
             "grant_type": "authorization_code",
             "code": code,
-            "redirect_uri": f"{request.url.scheme}://{request.url.netloc}{REDIRECT_PATH}",
+            "redirect_uri": get_redirect_uri(request),
             "client_id": OIDC_CLIENT_ID,
             "code_verifier": temp_session_data["code_verifier"],
         }
@@ -273,31 +688,27 @@ async def callback(request: Request, code: str, state: str):
         if OIDC_CLIENT_SECRET:
             token_data["client_secret"] = OIDC_CLIENT_SECRET
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(token_endpoint, data=token_data)
-            if response.status_code != 200:
-                raise OIDCError(f"Token exchange failed: {response.status_code}")
-            
-            tokens = response.json()
+        response = await http_client.post(token_endpoint, data=token_data)
+        if response.status_code != 200:
+            raise OIDCError(f"Token exchange failed: {response.status_code}")
+        
+        tokens = orjson.loads(response.content)
         
         # Extract user info from ID token
         id_token = tokens.get("id_token")
         if not id_token:
             raise OIDCError("No ID token received")
         
-        # Decode ID token (simplified - should validate signature in production)
-        try:
-            user_info = jwt.get_unverified_claims(id_token)
-        except JWTError:
-            raise OIDCError("Invalid ID token")
+        # Validate ID token against the provider's JWKS
+        user_info = await verify_id_token(id_token)
         
         # Add token expiry time
         if "expires_in" in tokens:
             tokens["expires_at"] = time.time() + tokens["expires_in"]
         
         # Create session
-        session_id = create_session(user_info, tokens)
-        session_cookie = serializer.dumps(session_id)
+        session = await create_session(user_info, tokens)
+        session_cookie = serializer.dumps(session["session_id"])
         
         # Create response with cookies
         response = RedirectResponse(url=FRONTEND_ORIGIN)
@@ -307,14 +718,14 @@ async def callback(request: Request, code: str, state: str):
             httponly=True,
             secure=COOKIE_SECURE,
             samesite=COOKIE_SAMESITE,
-            max_age=24*3600  # 24 hours
+            max_age=SESSION_TTL
         )
         response.set_cookie(
             key="csrf",
-            value=sessions[session_id]["csrf_token"],
+            value=session["csrf_token"],
             secure=COOKIE_SECURE,
             samesite=COOKIE_SAMESITE,
-            max_age=24*3600  # 24 hours
+            max_age=SESSION_TTL
         )
         
         return response
@@ -337,14 +748,12 @@ async def get_user_info(session: Dict[str, Any] = Depends(require_session)):
 @app.post("/bff/logout")
 async def logout(request: Request, _: None = Depends(require_csrf)):
     """Logout user and clear session."""
-    session = get_session_from_request(request)
+    # The session ID comes straight from the signed cookie, no need to load the session
+    session_id = get_session_id_from_request(request)
     
-    if session:
-        # Find and remove session
-        for session_id, stored_session in list(sessions.items()):
-            if stored_session == session:
-                sessions.pop(session_id, None)
-                break
+    if session_id:
+        await delete_session(session_id)
+        verified_cookies.pop(request.cookies["sid"], None)
     
     # Clear cookies
     response = Response(status_code=200)
@@ -386,6 +795,14 @@ async def protected_api_example(session: Dict[str, Any] = Depends(require_sessio
         }
     }
 
+async def stream_upstream_body(upstream_response: httpx.Response) -> AsyncIterator[bytes]:
+    """Yield the raw upstream body, releasing the connection even if streaming fails."""
+    try:
+        async for chunk in upstream_response.aiter_raw():
+            yield chunk
+    finally:
+        await upstream_response.aclose()
+
 @app.api_route("/bff/api/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
 async def proxy_api(
     path: str,
@@ -405,37 +822,57 @@ async def proxy_api(
     if not access_token:
         raise HTTPException(status_code=401, detail="No access token available")
     
-    # Prepare headers
-    headers = dict(request.headers)
-    headers["Authorization"] = f"Bearer {access_token}"
+    # Stream the request body upstream instead of reading it into memory
+    has_body = request.method in ["POST", "PUT", "PATCH"]
+    body = request.stream() if has_body else None
     
-    # Remove problematic headers
-    headers.pop("host", None)
-    headers.pop("content-length", None)
+    # Prepare headers: end-to-end headers only (plus any named in Connection), with our own host/authorization.
+    # BFF session credentials (cookies, CSRF token) never leave the BFF.
+    # content-length is kept for streamed bodies so httpx doesn't fall back to chunked encoding.
+    connection_headers = {name.strip().lower() for name in request.headers.get("connection", "").split(",")}
+    headers = [
+        (key, value)
+        for key, value in request.headers.items()
+        if key not in HOP_BY_HOP_HEADERS
+        and key not in connection_headers
+        and key not in ("host", "authorization", "cookie", "x-csrf-token")
+        and (has_body or key != "content-length")
+    ]
+    headers.append(("authorization", f"Bearer {access_token}"))
     
     # Prepare request
     url = f"{API_BASE_URL.rstrip('/')}/{path.lstrip('/')}"
-    body = await request.body() if request.method in ["POST", "PUT", "PATCH"] else None
     
+    upstream_request = http_client.build_request(
+        method=request.method,
+        url=url,
+        headers=headers,
+        params=request.query_params,
+        content=body,
+    )
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.request(
-                method=request.method,
-                url=url,
-                headers=headers,
-                params=request.query_params,
-                content=body,
-                timeout=30.0
-            )
-            
-            return Response(
-                content=response.content,
-                status_code=response.status_code,
-                headers=dict(response.headers)
-            )
+        upstream_response = await http_client.send(upstream_request, stream=True)
     except httpx.RequestError as e:
         raise HTTPException(status_code=502, detail=f"API request failed: {str(e)}")
+    
+    # Stream the body through as received (still content-encoded, so content-length stays valid)
+    response = StreamingResponse(
+        stream_upstream_body(upstream_response),
+        status_code=upstream_response.status_code,
+        # Also covers a client disconnect before streaming starts, when the generator never runs
+        background=BackgroundTask(upstream_response.aclose),
+    )
+    for key, value in upstream_response.headers.multi_items():
+        if key not in HOP_BY_HOP_HEADERS:
+            response.headers.append(key, value)
+    return response
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # In-memory sessions live in one process, so only scale out across workers with Redis
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=os.cpu_count() if REDIS_URL else 1,
+    )